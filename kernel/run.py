@@ -4,11 +4,14 @@
 # SPDX-License-Identifier: Apache-2.0 OR MIT
 
 import argparse
+import collections
+import concurrent.futures
 import os
 import sys
 import pathlib
 import shutil
 import subprocess
+import threading
 import prctl
 import signal
 import toml
@@ -16,15 +19,19 @@ import pexpect
 import plumbum
 import re
 import errno
+import fcntl
+import grp
+import pwd
+import hashlib
+import mmap
 from time import sleep
 
-from plumbum import colors, local, SshMachine
+from plumbum import colors, SshMachine
 from plumbum.commands import ProcessExecutionError
 
-from plumbum.cmd import whoami, python3, cat, getent, whoami
-try:
-    from plumbum.cmd import xargo
-except ImportError as e:
+from plumbum.cmd import python3, cat, getent
+XARGO = shutil.which('xargo')
+if XARGO is None:
     print("Unable to find the `xargo` binary in your $PATH")
     print("")
     print("Make sure to invoke `setup.sh` to install it.")
@@ -41,25 +48,62 @@ def exception_handler(exception_type, exception, traceback):
 # run.py script settings
 #
 SCRIPT_PATH = pathlib.Path(os.path.dirname(os.path.realpath(__file__)))
-CARGO_DEFAULT_ARGS = ["--color", "always"]
 ARCH = "x86_64"
+# The xargo version we build with
+XARGO_VERSION = "0.3.26"
 # TODO: should be generated for enabling parallel builds
 QEMU_TAP_NAME = 'tap0'
 QEMU_TAP_ZONE = '172.31.0.20/24'
+# Who we run as (the tap interface gets assigned to this user and group)
+USER = os.environ.get('USER') or pwd.getpwuid(os.getuid()).pw_name
+GROUP = grp.getgrgid(os.getgid()).gr_name
+# How many lines of QEMU's stderr we keep around to report on failures
+QEMU_STDERR_TAIL = 4096
+# Whether we run on CI (GitHub Actions and most other CIs set CI=true)
+ON_CI = os.environ.get('CI', '').lower() in ('true', '1')
 
 #
 # Important globals
 #
-BOOTLOADER_PATH = (SCRIPT_PATH / '..').resolve() / 'bootloader'
-TARGET_PATH = (SCRIPT_PATH / '..').resolve() / 'target'
+# SCRIPT_PATH is already resolved, so all of these are absolute paths
+ROOT_PATH = SCRIPT_PATH.parent
+BOOTLOADER_PATH = ROOT_PATH / 'bootloader'
+TARGET_PATH = ROOT_PATH / 'target'
 KERNEL_PATH = SCRIPT_PATH
-LIBS_PATH = (SCRIPT_PATH / '..').resolve() / 'lib'
-USR_PATH = (SCRIPT_PATH / '..').resolve() / 'usr'
+LIBS_PATH = ROOT_PATH / 'lib'
+USR_PATH = ROOT_PATH / 'usr'
 
 UEFI_TARGET = "{}-uefi".format(ARCH)
 KERNEL_TARGET = "{}-nrk".format(ARCH)
 USER_TARGET = "{}-nrk-none".format(ARCH)
 USER_RUSTFLAGS = "-Clink-arg=-zmax-page-size=0x200000"
+# Environment variables inherited by xargo that change its build output
+BUILD_ENV_VARS = ['RUSTFLAGS', 'RUSTC', 'RUSTC_WRAPPER', 'RUSTUP_TOOLCHAIN',
+                  'CARGO_INCREMENTAL', 'CARGO_TARGET_DIR', 'XARGO_HOME']
+
+# ioctl to reflink a file (see ioctl_ficlone(2))
+FICLONE = 0x40049409
+
+# QEMU arguments that are the same for every run
+_QEMU_STATIC_ARGS = (
+    '-no-reboot',
+    # Setup KVM and required guest hardware features
+    '-enable-kvm',
+    '-cpu', 'host,migratable=no,+invtsc,+tsc,+x2apic,+fsgsbase',
+    # Use serial communication
+    # '-nographic',
+    '-display', 'none', '-serial', 'stdio',
+    # Add UEFI bootloader support
+    '-drive', 'if=pflash,format=raw,file={}/OVMF_CODE.fd,readonly=on'.format(
+        BOOTLOADER_PATH),
+    '-drive', 'if=pflash,format=raw,file={}/OVMF_VARS.fd,readonly=on'.format(
+        BOOTLOADER_PATH),
+    # The ESP dir gets attached as drive `esp` (see `run_qemu`)
+    '-device', 'ahci,id=ahci,multifunction=on',
+    '-device', 'ide-hd,bus=ahci.0,drive=esp',
+    # Debug port to exit qemu and communicate back exit-code for tests
+    '-device', 'isa-debug-exit,iobase=0xf4,iosize=0x04',
+)
 
 #
 # Command line argument parser
@@ -84,6 +128,8 @@ parser.add_argument("--cmd", type=str,
                     help="Command line arguments passed to the kernel.")
 parser.add_argument("--machine",
                     help='Which machine to run on (defaults to qemu)', required=False, default='qemu')
+parser.add_argument("--watch", action="store_true", default=False,
+                    help="Keep running and rebuild, deploy & run again whenever a source file changes.", required=False)
 
 # QEMU related arguments
 parser.add_argument("--qemu-nodes", type=int,
@@ -131,131 +177,454 @@ NRK_EXIT_CODES = {
 }
 
 
+# Serializes output of the concurrently running build stages
+LOG_LOCK = threading.Lock()
+
+
 def log(msg):
-    print(colors.bold | ">>>", end=" "),
-    print(colors.bold.reset & colors.info | msg)
+    with LOG_LOCK:
+        print(colors.bold | ">>>", end=" "),
+        print(colors.bold.reset & colors.info | msg)
+
+
+def xargo_is_pinned():
+    "Checks whether XARGO is the pinned xargo version"
+    version = subprocess.run([XARGO, '--version'], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, text=True)
+    return re.search(r'^xargo {}\b'.format(re.escape(XARGO_VERSION)),
+                     version.stdout, re.MULTILINE) is not None
+
+
+def ensure_xargo():
+    "Makes sure the pinned xargo version is installed"
+    if xargo_is_pinned():
+        return
+    log("Install xargo {}".format(XARGO_VERSION))
+    # A debug build of xargo is plenty fast and takes much less time to build.
+    # We install over the xargo we found (in <root>/bin), so XARGO stays valid.
+    subprocess.run(['cargo', 'install', '--debug', '--locked', '--force',
+                    '--root', pathlib.Path(XARGO).parent.parent, 'xargo',
+                    '--version', XARGO_VERSION], check=True)
+    if not xargo_is_pinned():
+        print("{} is still not xargo {}.".format(XARGO, XARGO_VERSION))
+        sys.exit(errno.ENOENT)
+
+
+def hash_file(hasher, path):
+    "Feeds the content of the file at `path` into `hasher`"
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            hasher.update(content)
+
+
+def crate_inputs(crate_path, visited=None):
+    """
+    Returns all files that go into building the crate at `crate_path`,
+    including the ones of its (transitive) path dependencies.
+    """
+    crate_path = pathlib.Path(os.path.normpath(crate_path))
+    visited = set() if visited is None else visited
+    if crate_path in visited or not (crate_path / 'Cargo.toml').is_file():
+        return []
+    visited.add(crate_path)
+
+    inputs = [crate_path / f for f in ['Cargo.toml', 'Xargo.toml',
+                                       'build.rs', '.cargo/config']]
+    inputs += [f for f in (crate_path / 'src').rglob('*') if f.is_file()]
+
+    manifest = toml.load(crate_path / 'Cargo.toml')
+    tables = [manifest] + list(manifest.get('target', {}).values())
+    for table in tables:
+        for section in ['dependencies', 'build-dependencies']:
+            for dep in table.get(section, {}).values():
+                if isinstance(dep, dict) and 'path' in dep:
+                    inputs += crate_inputs(crate_path /
+                                           dep['path'], visited)
+    return inputs
+
+
+def build_hash(cwd, target_spec, build_args, env, extra_inputs=()):
+    """
+    Computes a hash over everything that determines the outcome of a build
+    step: The sources of the crate, the target specification, the toolchain,
+    the arguments and environment passed to xargo and `extra_inputs` (e.g.,
+    artifacts of other stages that a build script depends on).
+
+    Knowingly ignored are inputs outside of the repository that build
+    scripts pick up: The C toolchain and CC/CFLAGS used by the kernel's `cc`
+    build, the git HEAD embedded as GIT_HASH in the kernel, and the
+    rumprun toolchain and packages checkout used by rkapps. Remove the
+    target/.build-stamp-* files to force a rebuild after changing those.
+    """
+    hasher = hashlib.blake2b()
+    inputs = [ROOT_PATH / 'Cargo.toml', ROOT_PATH / 'Cargo.lock',
+              ROOT_PATH / 'rust-toolchain', pathlib.Path(target_spec)]
+    inputs += sorted(crate_inputs(cwd))
+    inputs += [pathlib.Path(f) for f in extra_inputs]
+    for path in inputs:
+        if path.is_file():
+            hasher.update(str(path).encode())
+            hash_file(hasher, path)
+    env = {**{k: os.environ[k] for k in BUILD_ENV_VARS if k in os.environ},
+           **env}
+    hasher.update(repr((build_args, sorted(env.items()))).encode())
+    return hasher.hexdigest()
+
+
+def output_stamp(digest, outputs):
+    """
+    Returns the stamp of a build with input hash `digest` that produced
+    `outputs` (or None if one of them doesn't exist). `outputs` may contain
+    glob patterns for builds that produce a varying set of files.
+    """
+    stamp = [digest]
+    for output in map(pathlib.Path, outputs):
+        if any(c in output.name for c in '*?['):
+            files = sorted(output.parent.glob(output.name))
+        else:
+            files = [output]
+        for f in files:
+            try:
+                f_stat = os.stat(f)
+            except FileNotFoundError:
+                return None
+            stamp.append("{} {} {}".format(
+                f, f_stat.st_size, f_stat.st_mtime_ns))
+    return "\n".join(stamp)
+
+
+def xargo_build(stage, cwd, target_spec, outputs, build_args, verbose=False,
+                extra_inputs=(), **env):
+    """
+    Invokes `xargo` with `build_args` in `cwd` and `env` added to the
+    environment.
+
+    The build stages run concurrently, so we can't rely on `local.cwd`
+    and `local.env` here (they modify process-wide state), instead cwd and
+    env are handed to the child process directly. We also bypass plumbum
+    and spawn xargo with `subprocess` which can use vfork (no copy of our
+    page tables) for the launch.
+
+    The build is skipped if none of its inputs changed since the last
+    successful build of `stage` (tracked with a stamp file in TARGET_PATH)
+    and its `outputs` are still the ones that build produced.
+    """
+    env = {k: str(v) for k, v in env.items()}
+    stamp = TARGET_PATH / '.build-stamp-{}'.format(stage)
+    digest = build_hash(cwd, target_spec, build_args, env, extra_inputs)
+    current = output_stamp(digest, outputs)
+    if current and stamp.is_file() and stamp.read_text() == current:
+        log("{} is up to date, skipping build.".format(stage))
+        return
+
+    if verbose:
+        with LOG_LOCK:
+            print("cd {}".format(cwd))
+            print(" ".join("{}={}".format(k, v) for k, v in env.items()) +
+                  " xargo " + " ".join(build_args))
+    argv = [XARGO, *build_args]
+    build = subprocess.run(argv, cwd=cwd, env={**os.environ, **env},
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           text=True, errors='replace')
+    if build.returncode != 0:
+        raise ProcessExecutionError(argv, build.returncode,
+                                    build.stdout, build.stderr)
+
+    built = output_stamp(digest, outputs)
+    if built:
+        stamp.parent.mkdir(parents=True, exist_ok=True)
+        stamp.write_text(built)
+
+
+def cargo_default_args(args):
+    "Returns the arguments we pass to every cargo invocation"
+    default_args = ("--color", "always")
+    if args.release:
+        default_args += ("--release",)
+    if args.verbose:
+        default_args += ("--verbose",)
+    return default_args
+
+
+def cargo_features(features):
+    "Returns the cargo arguments to enable all `features`"
+    return tuple(arg for feature in features for arg in ('--features', feature))
 
 
 def build_bootloader(args):
     "Builds the bootloader, copies the binary in the target UEFI directory"
     log("Build bootloader")
-    uefi_build_args = ['build', '--target', UEFI_TARGET]
-    uefi_build_args += ['--package', 'bootloader']
-    uefi_build_args += CARGO_DEFAULT_ARGS
+    uefi_build_args = ('build', '--target', UEFI_TARGET,
+                       '--package', 'bootloader', *cargo_default_args(args))
 
-    with local.cwd(BOOTLOADER_PATH):
-        with local.env(RUST_TARGET_PATH=BOOTLOADER_PATH.absolute()):
-            if args.verbose:
-                print("cd {}".format(BOOTLOADER_PATH))
-                print("RUST_TARGET_PATH={} xargo ".format(
-                    BOOTLOADER_PATH.absolute()) + " ".join(uefi_build_args))
-            xargo(*uefi_build_args)
+    debug_release = 'release' if args.release else 'debug'
+    output = TARGET_PATH / UEFI_TARGET / debug_release / 'bootloader.efi'
+    xargo_build('bootloader', BOOTLOADER_PATH, BOOTLOADER_PATH / '{}.json'.format(UEFI_TARGET),
+                [output], uefi_build_args, verbose=args.verbose,
+                RUST_TARGET_PATH=BOOTLOADER_PATH)
 
 
 def build_kernel(args):
     "Builds the kernel binary"
     log("Build kernel")
-    with local.cwd(KERNEL_PATH):
-        with local.env(RUST_TARGET_PATH=(KERNEL_PATH / 'src' / 'arch' / ARCH).absolute()):
-            # TODO(cross-compilation): in case we use a cross compiler/linker
-            # also set: CARGO_TARGET_X86_64_NRK_LINKER=x86_64-elf-ld
-            build_args = ['build', '--target', KERNEL_TARGET]
-            if args.no_kfeatures:
-                build_args += ["--no-default-features"]
-            for feature in args.kfeatures:
-                build_args += ['--features', feature]
-            build_args += CARGO_DEFAULT_ARGS
-            if args.verbose:
-                print("cd {}".format(KERNEL_PATH))
-                print("RUST_TARGET_PATH={} xargo ".format(
-                    KERNEL_PATH / 'src' / 'arch' / ARCH) + " ".join(build_args))
-            xargo(*build_args)
+    # TODO(cross-compilation): in case we use a cross compiler/linker
+    # also set: CARGO_TARGET_X86_64_NRK_LINKER=x86_64-elf-ld
+    no_default_features = ("--no-default-features",) if args.no_kfeatures else ()
+    build_args = ('build', '--target', KERNEL_TARGET, *no_default_features,
+                  *cargo_features(args.kfeatures), *cargo_default_args(args))
+
+    debug_release = 'release' if args.release else 'debug'
+    output = TARGET_PATH / KERNEL_TARGET / debug_release / 'nrk'
+    kernel_target_path = KERNEL_PATH / 'src' / 'arch' / ARCH
+    xargo_build('kernel', KERNEL_PATH, kernel_target_path / '{}.json'.format(KERNEL_TARGET),
+                [output], build_args, verbose=args.verbose,
+                RUST_TARGET_PATH=kernel_target_path)
 
 
 def build_user_libraries(args):
     "Builds nrk vibrio lib to provide runtime support for other rump based apps"
     log("Build user-space lib vibrio")
-    build_args = ['build', '--target', USER_TARGET]
-    build_args += ["--features", "rumprt"]
+    features = ["rumprt"]
     if args.nic == "virtio":
-        build_args += ["--features", "virtio"]
+        features += ["virtio"]
     # else: use e1000 / wm0
-    build_args += CARGO_DEFAULT_ARGS
+    build_args = ('build', '--target', USER_TARGET,
+                  *cargo_features(features), *cargo_default_args(args))
 
     # Make sure we build a static (.a) vibrio library
     # For linking with rumpkernel
-    with local.cwd(LIBS_PATH / "vibrio"):
-        with local.env(RUSTFLAGS=USER_RUSTFLAGS):
-            with local.env(RUST_TARGET_PATH=USR_PATH.absolute()):
-                if args.verbose:
-                    print("cd {}".format(LIBS_PATH / "vibrio"))
-                    print("RUSTFLAGS={} RUST_TARGET_PATH={} xargo ".format(USER_RUSTFLAGS,
-                                                                           USR_PATH.absolute()) + " ".join(build_args))
-                xargo(*build_args)
+    debug_release = 'release' if args.release else 'debug'
+    output = TARGET_PATH / USER_TARGET / debug_release / 'libvibrio.a'
+    xargo_build('vibrio', LIBS_PATH / "vibrio", USR_PATH / '{}.json'.format(USER_TARGET),
+                [output], build_args, verbose=args.verbose,
+                RUSTFLAGS=USER_RUSTFLAGS, RUST_TARGET_PATH=USR_PATH)
 
 
-def build_userspace(args):
-    "Builds user-space programs"
-    build_args_default = ['build', '--target', USER_TARGET]
-    build_args_default += CARGO_DEFAULT_ARGS
+def build_userspace(args, executor):
+    "Builds user-space programs (using the thread pool `executor`)"
+    build_args_default = ('build', '--target', USER_TARGET,
+                          *cargo_default_args(args))
+    debug_release = 'release' if args.release else 'debug'
+    user_build_path = TARGET_PATH / USER_TARGET / debug_release
 
+    def build_module(module):
+        features = []
+        for feature in args.ufeatures:
+            if ':' in feature:
+                mod_part, feature_part = feature.split(':')
+                if module == mod_part:
+                    features += [feature_part]
+            else:
+                features += [feature]
+        build_args = build_args_default + cargo_features(features)
+        outputs = [user_build_path / module]
+        if module == "rkapps":
+            # TODO(ugly): rkapps builds its apps as multiple .bin binaries
+            outputs += [user_build_path / '*.bin']
+        log("Build user-module {}".format(module))
+        # Modules get (re-)linked with the vibrio from the build_user_libraries
+        # stage (e.g., rkapps' build.rs watches libvibrio.a)
+        xargo_build('user-{}'.format(module), USR_PATH / module, USR_PATH / '{}.json'.format(USER_TARGET),
+                    outputs, build_args, verbose=args.verbose,
+                    extra_inputs=[user_build_path / 'libvibrio.a'],
+                    RUSTFLAGS=USER_RUSTFLAGS, RUST_TARGET_PATH=USR_PATH)
+
+    # Modules build independently, so we can build all of them at once
+    builds = []
     for module in args.mods:
         if not (USR_PATH / module).exists():
             log("User module {} not found, skipping.".format(module))
             continue
-        with local.cwd(USR_PATH / module):
-            with local.env(RUSTFLAGS=USER_RUSTFLAGS):
-                with local.env(RUST_TARGET_PATH=USR_PATH.absolute()):
-                    build_args = build_args_default.copy()
-                    for feature in args.ufeatures:
-                        if ':' in feature:
-                            mod_part, feature_part = feature.split(':')
-                            if module == mod_part:
-                                build_args += ['--features', feature_part]
-                        else:
-                            build_args += ['--features', feature]
-                    log("Build user-module {}".format(module))
-                    if args.verbose:
-                        print("cd {}".format(USR_PATH / module))
-                        print("RUSTFLAGS={} RUST_TARGET_PATH={} xargo ".format(
-                            USER_RUSTFLAGS, USR_PATH.absolute()) + " ".join(build_args))
-                    xargo(*build_args)
-
-
-def deploy(args):
+        builds.append(executor.submit(build_module, module))
+    for build in builds:
+        build.result()
+
+
+def fetch_dependencies(args):
+    """
+    Downloads the external dependencies of all crates up-front, so the
+    concurrent builds don't wait on each other for the cargo package cache.
+    """
+    log("Fetch dependencies")
+    argv = ['cargo', 'fetch', '--color', 'always']
+    if args.verbose:
+        print("cd {}".format(ROOT_PATH))
+        print(" ".join(argv))
+    subprocess.run(argv, cwd=ROOT_PATH, check=True)
+
+
+def build_all(args, executor):
+    """
+    Builds bootloader, kernel, vibrio and the user-space programs (using the
+    thread pool `executor`).
+
+    These can't be built with a single xargo invocation: xargo builds the
+    sysroot for one target at a time, the targets need different
+    RUST_TARGET_PATH/RUSTFLAGS and cargo would unify the features of all
+    packages in one build (e.g., rkapps enabling `vibrio/rumprt` would leak
+    into init).
+    """
+    # bootloader, kernel and vibrio are built for different targets, so
+    # their xargo sysroot builds can overlap (cargo itself serializes on the
+    # lock of the shared target dir).
+    stages = [executor.submit(build_bootloader, args),
+              executor.submit(build_kernel, args),
+              executor.submit(build_user_libraries, args)]
+    # Wait for all of them, so no stage keeps running if another one failed
+    concurrent.futures.wait(stages)
+    errors = [stage.exception() for stage in stages if stage.exception()]
+    for error in errors[1:]:
+        print("{}: {}".format(type(error).__name__, error))
+    for stage in stages:
+        stage.result()
+
+    # user-space programs link against vibrio
+    build_userspace(args, executor)
+
+
+def fast_copy(src, dst):
+    """
+    Copies `src` to `dst` including metadata (like `shutil.copy2`).
+
+    Tries to reflink the file first (instant on btrfs/xfs), then to copy
+    it in-kernel with `sendfile` and only then falls back to a regular copy.
+    """
+    src, dst = pathlib.Path(src), pathlib.Path(dst)
+    if dst.is_dir():
+        dst = dst / src.name
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            try:
+                size = os.fstat(fsrc.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(),
+                                       offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def copy_if_changed(src, dst):
+    """
+    Like `fast_copy` but leaves `dst` alone if it already has the same
+    content as `src`.
+    """
+    src, dst = pathlib.Path(src), pathlib.Path(dst)
+    if dst.is_dir():
+        dst = dst / src.name
+    try:
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+    except FileNotFoundError:
+        return fast_copy(src, dst)
+
+    # Fast path: same file, or an earlier copy of it (which keeps the
+    # mtime), before falling back to comparing content hashes
+    same_file = (src_stat.st_dev, src_stat.st_ino) == (
+        dst_stat.st_dev, dst_stat.st_ino)
+    if same_file or (src_stat.st_size == dst_stat.st_size and
+                     src_stat.st_mtime_ns == dst_stat.st_mtime_ns):
+        return dst
+    if src_stat.st_size == dst_stat.st_size:
+        src_hash, dst_hash = hashlib.blake2b(), hashlib.blake2b()
+        hash_file(src_hash, src)
+        hash_file(dst_hash, dst)
+        if src_hash.digest() == dst_hash.digest():
+            return dst
+    return fast_copy(src, dst)
+
+
+def write_if_changed(path, payload):
+    """
+    Atomically replaces the file at `path` with `payload` (bytes), unless
+    it has this content already (so its mtime only changes with its
+    content).
+    """
+    path = pathlib.Path(path)
+    try:
+        if path.read_bytes() == payload:
+            return
+    except FileNotFoundError:
+        pass
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    with open(fd, 'wb') as tmp_file:
+        tmp_file.write(payload)
+    os.replace(tmp_path, path)
+
+
+def sync_dir(files, dst_path, executor, keep=()):
+    """
+    Updates `dst_path` so it contains `files` (a dict mapping paths relative
+    to `dst_path` to their source file) and the paths in `keep`.
+
+    Only files that changed get copied (using the thread pool `executor`)
+    and anything else in `dst_path` is removed.
+    """
+    dst_path = pathlib.Path(dst_path)
+    wanted = {pathlib.PurePath(f) for f in files} | {
+        pathlib.PurePath(f) for f in keep}
+    wanted_dirs = {parent for f in wanted for parent in f.parents}
+
+    def prune(path, rel):
+        for entry in os.scandir(path):
+            entry_rel = rel / entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if entry_rel in wanted_dirs:
+                    prune(entry.path, entry_rel)
+                else:
+                    shutil.rmtree(entry.path)
+            elif entry_rel not in wanted:
+                os.unlink(entry.path)
+
+    dst_path.mkdir(parents=True, exist_ok=True)
+    prune(dst_path, pathlib.PurePath())
+
+    # Copying is I/O bound, so overlap the copies
+    copies = []
+    for rel, src in files.items():
+        dst = dst_path / rel
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        copies.append(executor.submit(copy_if_changed, src, dst))
+    for copy in copies:
+        copy.result()
+
+
+def deploy(args, executor):
     """
     Deploys everything that got built to the UEFI ESP directory
     Also builds a disk image (.img file)
     """
     log("Deploy binaries")
 
-    # Clean up / create ESP dir structure
     debug_release = 'release' if args.release else 'debug'
     uefi_build_path = TARGET_PATH / UEFI_TARGET / debug_release
     user_build_path = TARGET_PATH / USER_TARGET / debug_release
     kernel_build_path = TARGET_PATH / KERNEL_TARGET / debug_release
 
-    # Clean and create_esp dir:
     esp_path = uefi_build_path / 'esp'
-    if esp_path.exists() and esp_path.is_dir():
-        shutil.rmtree(esp_path, ignore_errors=False)
     esp_boot_path = esp_path / "EFI" / "Boot"
     esp_boot_path.mkdir(parents=True, exist_ok=True)
 
-    # Deploy bootloader
-    shutil.copy2(kernel_build_path / 'nrk', os.getcwd())
-    shutil.copy2(kernel_build_path / 'nrk', esp_path / 'kernel')
-
-    # Deploy kernel
-    shutil.copy2(uefi_build_path / 'bootloader.efi',
-                 esp_boot_path / 'BootX64.efi')
-
-    # Write kernel cmd-line file in ESP dir
-    with open(esp_path / 'cmdline.in', 'w') as cmdfile:
-        if args.cmd:
-            cmdfile.write('./kernel {}'.format(args.cmd))
-        else:
-            cmdfile.write('./kernel')
+    copy_if_changed(kernel_build_path / 'nrk', os.getcwd())
+    esp_files = {
+        # Deploy kernel
+        'kernel': kernel_build_path / 'nrk',
+        # Deploy bootloader
+        'EFI/Boot/BootX64.efi': uefi_build_path / 'bootloader.efi',
+    }
 
     deployed = []
     # Deploy user-modules
@@ -264,28 +633,35 @@ def deploy(args):
             log("[WARN] Module not found: {}".format(module))
             continue
         if module != "rkapps":
-            shutil.copy2(user_build_path / module, esp_path)
+            esp_files[module] = user_build_path / module
             deployed.append(module)
         else:
             # TODO(ugly): Special handling of the rkapps module
             # (they end up being built as multiple .bin binaries)
-            to_copy = [app for app in user_build_path.glob(
-                "*.bin") if app.is_file()]
-            deployed.extend([f.name for f in to_copy])
-            for app in to_copy:
-                shutil.copy2(app, esp_path)
+            apps = [pathlib.Path(app.path) for app in os.scandir(user_build_path)
+                    if app.name.endswith(".bin") and app.is_file()]
+            deployed.extend([f.name for f in apps])
+            esp_files.update({f.name: f for f in apps})
+
+    # Update the ESP dir in place, leaving unchanged files alone
+    sync_dir(esp_files, esp_path, executor, keep=['cmdline.in', 'boot.php'])
 
     # Write kernel cmd-line file in ESP dir
-    with open(esp_path / 'boot.php', 'w') as boot_file:
-        ipxe_script = """#!ipxe
+    if args.cmd:
+        cmdline = './kernel {}'.format(args.cmd)
+    else:
+        cmdline = './kernel'
+    write_if_changed(esp_path / 'cmdline.in', cmdline.encode())
+
+    # Write iPXE boot script in ESP dir
+    ipxe_script = """#!ipxe
 imgfetch EFI/Boot/BootX64.efi
 imgfetch kernel
 imgfetch cmdline.in
 {}
 boot EFI/Boot/BootX64.efi
 """.format('\n'.join(['imgfetch {}'.format(m) for m in deployed]))
-
-        boot_file.write(ipxe_script)
+    write_if_changed(esp_path / 'boot.php', ipxe_script.encode())
 
 
 def run_qemu(args):
@@ -293,35 +669,16 @@ def run_qemu(args):
     Run the kernel on a QEMU instance.
     """
 
-    from plumbum.cmd import sudo, tunctl, ifconfig, corealloc
+    from plumbum.cmd import sudo, corealloc
     from plumbum.machines import LocalCommand
 
     log("Starting QEMU")
     debug_release = 'release' if args.release else 'debug'
     esp_path = TARGET_PATH / UEFI_TARGET / debug_release / 'esp'
 
-    qemu_default_args = ['-no-reboot']
-    # Setup KVM and required guest hardware features
-    qemu_default_args += ['-enable-kvm']
-    qemu_default_args += ['-cpu',
-                          'host,migratable=no,+invtsc,+tsc,+x2apic,+fsgsbase']
-    # Use serial communication
-    # '-nographic',
-    qemu_default_args += ['-display', 'none', '-serial', 'stdio']
-
-    # Add UEFI bootloader support
-    qemu_default_args += ['-drive',
-                          'if=pflash,format=raw,file={}/OVMF_CODE.fd,readonly=on'.format(BOOTLOADER_PATH)]
-    qemu_default_args += ['-drive',
-                          'if=pflash,format=raw,file={}/OVMF_VARS.fd,readonly=on'.format(BOOTLOADER_PATH)]
-    qemu_default_args += ['-device', 'ahci,id=ahci,multifunction=on']
+    qemu_default_args = list(_QEMU_STATIC_ARGS)
     qemu_default_args += ['-drive',
                           'if=none,format=raw,file=fat:rw:{},id=esp'.format(esp_path)]
-    qemu_default_args += ['-device', 'ide-hd,bus=ahci.0,drive=esp']
-
-    # Debug port to exit qemu and communicate back exit-code for tests
-    qemu_default_args += ['-device',
-                          'isa-debug-exit,iobase=0xf4,iosize=0x04']
 
     # Enable networking with outside world
     if args.nic != "vmxnet3":
@@ -443,23 +800,38 @@ def run_qemu(args):
         qemu_args += args.qemu_settings.split()
 
     # Create a tap interface to communicate with guest and give it an IP
-    user = (whoami)().strip()
-    group = (local['id']['-gn'])().strip()
+    # (unless it's already there from a previous run)
     # TODO: Could probably avoid 'sudo' here by doing
     # sudo setcap cap_net_admin .../run.py
     # in the setup.sh script
-    sudo[tunctl[['-t', QEMU_TAP_NAME, '-u', user, '-g', group]]]()
-    sudo[ifconfig[QEMU_TAP_NAME, QEMU_TAP_ZONE]]()
+    if not os.path.isdir('/sys/class/net/{}'.format(QEMU_TAP_NAME)):
+        subprocess.run(['sudo', 'tunctl', '-t', QEMU_TAP_NAME,
+                        '-u', USER, '-g', GROUP], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(['sudo', 'ifconfig', QEMU_TAP_NAME,
+                        QEMU_TAP_ZONE], check=True)
 
     # Run a QEMU instance
-    cmd = ['/usr/bin/env'] + qemu_args
+    cmd = qemu_args
     if args.verbose:
         print(' '.join(cmd))
 
     # Spawn qemu first, then set the guest CPU affinities
     # The `preexec_fn` ensures that qemu dies if run.py exits
     execution = subprocess.Popen(
-        cmd, stderr=None, stdout=None, env=os.environ.copy(), preexec_fn=lambda: prctl.set_pdeathsig(signal.SIGKILL))
+        cmd, stderr=subprocess.PIPE, stdout=None, bufsize=1, text=True, errors='replace', env=os.environ.copy(), preexec_fn=lambda: prctl.set_pdeathsig(signal.SIGKILL))
+
+    # Forward stderr as it arrives but remember the last bit of it in case
+    # we need to report a failure
+    stderr_tail = collections.deque(maxlen=QEMU_STDERR_TAIL)
+
+    def tee_stderr():
+        for line in execution.stderr:
+            sys.stderr.write(line)
+            sys.stderr.flush()
+            stderr_tail.append(line)
+
+    stderr_reader = threading.Thread(target=tee_stderr, daemon=True)
+    stderr_reader.start()
 
     LocalCommand.QUOTE_LEVEL = 3
 
@@ -490,6 +862,7 @@ def run_qemu(args):
 
     # Wait until qemu exits
     execution.wait()
+    stderr_reader.join()
 
     nrk_exit_code = execution.returncode >> 1
     if NRK_EXIT_CODES.get(nrk_exit_code):
@@ -500,8 +873,8 @@ def run_qemu(args):
 
     if nrk_exit_code != 0:
         log("Invocation was: {}".format(cmd))
-        if execution.stderr:
-            print("STDERR: {}".format(execution.stderr.decode('utf-8')))
+        if stderr_tail:
+            print("STDERR: {}".format(''.join(stderr_tail)))
 
     # If the test creates a fake pmem path; remove it.
     if os.path.isfile(pmem_test_path):
@@ -646,6 +1019,83 @@ def run(args):
         return run_baremetal(args)
 
 
+def build_deploy_run(args, executor):
+    """
+    Builds, deploys and (unless --norun is given) runs the system.
+    Returns: A nrk exit error code or None if the system wasn't run.
+    """
+    build_all(args, executor)
+    sccache = shutil.which('sccache')
+    if sccache and args.verbose:
+        subprocess.run([sccache, '--show-stats'])
+
+    deploy(args, executor)
+
+    if not args.norun:
+        return run(args)
+
+
+def watch(args, executor):
+    """
+    Builds, deploys and runs the system, then waits for changes to source
+    files of the bootloader, kernel, libraries or user-space programs and
+    does it again whenever that happens (until interrupted with Ctrl-C).
+    Returns: The result of the last iteration (1 if it failed, None if
+    there was none or the system wasn't run).
+    """
+    try:
+        from watchdog.events import PatternMatchingEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        print("Unable to import `watchdog` (required for --watch).")
+        print("Install it with `sudo apt install python3-watchdog`.")
+        sys.exit(errno.ENOENT)
+
+    # Editors and cargo tend to touch files in bursts, so we wait for 200 ms
+    # without further events before we start another build
+    changed = threading.Event()
+    debounce_lock = threading.Lock()
+    debounce_timer = None
+
+    def on_change(event):
+        nonlocal debounce_timer
+        # Ignore open/close events (e.g. from hashing the sources)
+        if event.event_type not in ['created', 'modified', 'moved', 'deleted']:
+            return
+        with debounce_lock:
+            if debounce_timer:
+                debounce_timer.cancel()
+            debounce_timer = threading.Timer(0.2, changed.set)
+            debounce_timer.start()
+
+    handler = PatternMatchingEventHandler(
+        patterns=['*.rs', '*.toml'], ignore_directories=True)
+    handler.on_any_event = on_change
+    observer = Observer()
+    for path in [BOOTLOADER_PATH, KERNEL_PATH, LIBS_PATH, USR_PATH]:
+        observer.schedule(handler, str(path), recursive=True)
+    observer.start()
+
+    result = None
+    try:
+        while True:
+            try:
+                result = build_deploy_run(args, executor)
+            except (ProcessExecutionError, subprocess.CalledProcessError, OSError) as e:
+                # Keep watching, the next change might fix it
+                print("{}: {}".format(type(e).__name__, e))
+                result = 1
+            log("Watching for changes (Ctrl-C to stop)")
+            changed.wait()
+            changed.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        observer.join()
+    return result
+
+
 #
 # Main routine of run.py
 #
@@ -653,34 +1103,50 @@ if __name__ == '__main__':
     "Execution pipeline for building and launching nrk"
     args = parser.parse_args()
 
-    user = whoami().strip()
     kvm_members = getent['group', 'kvm']().strip().split(":")[-1].split(',')
-    if not user in kvm_members and not args.norun:
-        print("Your user ({}) is not in the kvm group.".format(user))
-        print("Add yourself to the group with `sudo adduser {} kvm`".format(user))
+    if not USER in kvm_members and not args.norun:
+        print("Your user ({}) is not in the kvm group.".format(USER))
+        print("Add yourself to the group with `sudo adduser {} kvm`".format(USER))
         print("You'll likely have to restart for changes to take effect,")
         print("or run `sudo chmod +666 /dev/kvm` if you don't care about")
         print("kvm access restriction on the machine.")
         sys.exit(errno.EACCES)
 
-    if args.release:
-        CARGO_DEFAULT_ARGS.append("--release")
-    if args.verbose:
-        CARGO_DEFAULT_ARGS.append("--verbose")
-    else:
+    if not args.verbose:
         # Minimize python exception backtraces
         sys.excepthook = exception_handler
 
-        # Build
-    build_bootloader(args)
-    build_kernel(args)
-    build_user_libraries(args)
-    build_userspace(args)
-
-    # Deploy
-    deploy(args)
+    # All build stages share one target dir, so cargo can reuse the
+    # artifacts of common dependencies. On CI we disable incremental
+    # compilation, it mostly adds extra I/O in target/ there.
+    build_env = {'CARGO_TARGET_DIR': TARGET_PATH}
+    # Keep the xargo sysroot (libcore, liballoc etc.) next to the rest of the
+    # build artifacts
+    build_env['XARGO_HOME'] = os.environ.get(
+        'XARGO_HOME', TARGET_PATH / '.xargo')
+    if ON_CI:
+        build_env['CARGO_INCREMENTAL'] = '0'
+    # Cache rustc invocations with sccache (if it's installed)
+    sccache = shutil.which('sccache')
+    if sccache:
+        build_env['RUSTC_WRAPPER'] = sccache
+        build_env['SCCACHE_DIR'] = os.environ.get(
+            'SCCACHE_DIR', ROOT_PATH / '.sccache')
+
+    ensure_xargo()
+    os.environ.update({k: str(v) for k, v in build_env.items()})
+
+    # CI starts from an empty cargo package cache
+    if ON_CI:
+        fetch_dependencies(args)
+
+    # One thread pool for the build stages, user-modules and ESP copies,
+    # it stays around in --watch mode
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        if args.watch:
+            r = watch(args, executor)
+        else:
+            r = build_deploy_run(args, executor)
 
-    # Run
-    if not args.norun:
-        r = run(args)
+    if r is not None:
         sys.exit(r)